@@ -3,22 +3,24 @@
 from __future__ import print_function, division
 import os
 import time
-import Queue
 import socket
+import select
+import random
 import sys
 from PyQt4 import QtGui, QtCore
-from collections import namedtuple
-import matplotlib
-import matplotlib.animation
-import matplotlib.dates
-from matplotlib.backends.backend_qt4agg import FigureCanvasQTAgg
+from collections import namedtuple, deque
+from itertools import takewhile
+import pyqtgraph as pg
 import numpy as np
-import itertools
 from datetime import datetime, timedelta
-import shlex
+import re
 import argparse
 
+# clock for timeouts, python2 has no monotonic clock so fall back to wall time there
+monotonic = getattr(time, 'monotonic', time.time)
 MASStatus = namedtuple('MASStatus', 'spin, drive, bearing, sense, spin_set')
+# matches the MAS controller connection lines in symbols.sh with a double quoted, single quoted or bare value
+SYMBOL_PATTERN = re.compile(r'''^\s*export\s+(TRM1_TCP_NODE|TRM1_TCP_PORT)=(?:"([^"]*)"|'([^']*)'|(\S+))''')
 
 class MASView(QtGui.QWidget):
     """Window to control and view MAS controller operation.
@@ -46,16 +48,21 @@ class MASView(QtGui.QWidget):
         self.spinning_history = History(config.limits[-1], log_dir)
 
         self.build_ui()
-        self.command_queue = Queue.Queue()
-        self.MASThread = MASTCPThread(self, self.command_queue, offline)
+        self.MASThread = QtCore.QThread(self)
+        self.MASWorker = MASTCPWorker(self, offline)
+        self.MASWorker.moveToThread(self.MASThread)
+        self.connect(self.MASThread, QtCore.SIGNAL('started()'), self.MASWorker.start)
+        self.connect(self.MASWorker, QtCore.SIGNAL('got_status(PyQt_PyObject)'), self.got_status)
+        self.connect(self.MASWorker, QtCore.SIGNAL('reconnect(QString)'), self.reconnect_message)
+        self.connect(self, QtCore.SIGNAL('reconnect_controller()'), self.MASWorker.connect_controller)
+        self.connect(self, QtCore.SIGNAL('stop_controller()'), self.MASWorker.stop)
+        self.connect(self, QtCore.SIGNAL('queue_command(PyQt_PyObject)'), self.MASWorker.queue_command)
         self.MASThread.start()
-        self.connect(self.MASThread, QtCore.SIGNAL('got_status(PyQt_PyObject)'), self.got_status)
-        self.connect(self.MASThread, QtCore.SIGNAL('reconnect(QString)'), self.reconnect_message)
 
     def got_status(self, status):
         """Handle a new status being received from the MAS controller
 
-        This is called when a new status is obtained by the MASThread. The new
+        This is called when a new status is obtained by the MASWorker. The new
         measured spin rate is added to the plot and if the status has changed it
         is updated and displayed to the user in the controls GUI.
 
@@ -66,16 +73,33 @@ class MASView(QtGui.QWidget):
         if self.status == status[0]:
             return
 
+        old_status = self.status
         self.status = status[0]
-        self.update_displays()
+        self.update_displays(old_status)
 
-    def update_displays(self):
-        """Update GUI fields with status values."""
-        self.spin_display.setText(self.status.spin.rjust(self.spin_digits))
-        self.bearing_display.setText(self.status.bearing.rjust(self.pressure_digits))
-        self.drive_display.setText(self.status.drive.rjust(self.pressure_digits))
-        self.sense_display.setText(self.status.sense.rjust(self.pressure_digits))
-        self.spin_set_display.setText(self.status.spin_set.rjust(self.spin_digits))
+    def update_displays(self, old_status=None):
+        """Update GUI fields with status values.
+
+        Only fields whose values differ from old_status are updated, to avoid
+        repainting labels whose text has not changed.
+
+        Args:
+            old_status: optional previously displayed status, all fields are
+                updated if not given
+        """
+        displays = (
+            (self.spin_display, self.spin_digits),
+            (self.drive_display, self.pressure_digits),
+            (self.bearing_display, self.pressure_digits),
+            (self.sense_display, self.pressure_digits),
+            (self.spin_set_display, self.spin_digits))
+        if old_status is None:
+            old_status = (None,)*len(displays)
+
+        # displays are in the same order as the MASStatus fields
+        for value, old_value, (display, digits) in zip(self.status, old_status, displays):
+            if value != old_value:
+                display.setText(value.rjust(digits))
 
     def build_ui(self):
         """Set up the GUI elements."""
@@ -179,7 +203,7 @@ class MASView(QtGui.QWidget):
             button: the button that was clicked
         """
         if button == self.manual_button:
-            self.command_queue.put(('GM',))
+            self.queue_command(('GM',))
             self.spin_set_button.setEnabled(False)
             self.spin_set_box.setEnabled(False)
             self.drive_control.setEnabled(True)
@@ -188,25 +212,33 @@ class MASView(QtGui.QWidget):
             self.bearing_control.setValue(int(self.status.bearing))
 
         elif button == self.auto_button:
-            self.command_queue.put(('GA',))
+            self.queue_command(('GA',))
             self.spin_set_button.setEnabled(True)
             self.spin_set_box.setEnabled(True)
             self.drive_control.setEnabled(False)
             self.bearing_control.setEnabled(False)
             self.spin_set_box.setValue(int(self.status.spin))
 
+    def queue_command(self, command):
+        """Pass a command to the MASWorker to send to the MAS controller.
+
+        Args:
+            command: tuple of (command,(args...))
+        """
+        self.emit(QtCore.SIGNAL('queue_command(PyQt_PyObject)'), command)
+
     def set_bearing(self, val):
         """Send a bearing pressure to the MAS controller."""
-        self.command_queue.put(('BP', (str(val),)))
+        self.queue_command(('BP', (str(val),)))
 
     def set_drive(self, val):
         """Send a drive pressure to the MAS controller."""
-        self.command_queue.put(('DP', (str(val),)))
+        self.queue_command(('DP', (str(val),)))
 
     def set_spin(self):
         """Send the spin set point to the MAS controller."""
         spin_set = self.spin_set_box.value()
-        self.command_queue.put(('DS', (str(spin_set),)))
+        self.queue_command(('DS', (str(spin_set),)))
 
     def reconnect_message(self, message):
         """Launch a dialog when connection errors arise.
@@ -217,7 +249,7 @@ class MASView(QtGui.QWidget):
         Args:
             message: text to display about the connection issue
         """
-        self.spinning_history.add_point(datetime.now(), np.ma.masked)
+        self.spinning_history.add_point(datetime.now(), History.missing)
         dialog = QtGui.QMessageBox(self)
         dialog.setText(message)
         dialog.setInformativeText('Do you want to attempt to reconnect or end the program?')
@@ -225,8 +257,6 @@ class MASView(QtGui.QWidget):
         response = dialog.exec_()
 
         if response == QtGui.QMessageBox.Abort:
-            self.MASThread.running = False
-            self.MASThread.retry_dialog_open = False
             self.parent.quit()
         else:
             # disable all controls so the user must choose a mode before doing anything, just like when first starting
@@ -244,21 +274,20 @@ class MASView(QtGui.QWidget):
             self.auto_button.setChecked(False)
             self.mode_controls.setExclusive(True)
 
-            self.MASThread.retry_dialog_open = False
+            self.emit(QtCore.SIGNAL('reconnect_controller()'))
 
     def cleanup(self):
         """Ensure the connection to the MAS controller finishes properly.
 
         Makes sure the connection is close properly when the application is
-        closing. Tells the MASThread to stop running and waits for it to
+        closing. Tells the MASWorker to stop and waits for its thread to
         actually finish before exiting.
         
         Also writes any unlogged data from the spinning history if logging is
         active.
         """
-        self.MASThread.running = False
-        while self.MASThread.isRunning():
-            pass
+        self.emit(QtCore.SIGNAL('stop_controller()'))
+        self.MASThread.wait()
         if self.spinning_history.logging is True:
             self.spinning_history.end_logging()
         
@@ -266,16 +295,25 @@ class History():
     '''Updatable store of value of a parameter over time
 
     Holds a history of time-value pairs and allows adding additional points
-    indefinitely by periodically discarding points older than history_length.
+    indefinitely. Points are stored in ring buffers with a power of two capacity
+    indexed by a monotonic write index, so the oldest points are overwritten in
+    place once they are more than history_length older than the newest point.
+    Times are stored as float seconds since the epoch of the naive local time so
+    that searching and slicing operate on contiguous arrays of doubles.
 
     Args:
         history_length: Optional timedelta setting how long to keep data
         log_dir: Optional directory name to store log files
     '''
-    history_buffer = 1000 # number of empty points to allocate in the history (controls reallocation frequency)
+    history_buffer = 1000 # number of points to collect between writes to an active log file
+    expected_interval = 1 # expected seconds between points (sets the initial capacity)
+    epoch = datetime(1970, 1, 1)
+    time_format = '%Y-%m-%d-%H-%M-%S' # format of times in saved files and file names
+    missing = np.iinfo(np.int32).min # value marking points without a measurement (e.g. disconnections)
 
     def __init__(self, history_length = timedelta(hours=24), log_dir=None):
         self.history_length = history_length
+        self.history_seconds = history_length.total_seconds()
 
         if log_dir is None:
             self.log_dir = ''
@@ -287,12 +325,16 @@ class History():
             else: # disallow saving if the log_dir does not exist or can't be written to
                 self.can_save = False
 
-        self.times, self.values = self.allocate_arrays(self.history_buffer*2)
-        self.filled_points = 0
+        points = self.history_seconds/self.expected_interval+self.history_buffer
+        self.capacity = 1 << int(np.ceil(np.log2(points)))
+        self.mask = self.capacity-1
+        self.times, self.values = self.allocate_arrays(self.capacity)
+        self.write_idx = 0
 
         self.logging = False
-        self.log_start = datetime.now()
+        self.log_start = self.timestamp(datetime.now())
         self.log_end = self.log_start
+        self.log_idx = 0 # write index of the first point not yet written to the log
     
     def allocate_arrays(self, points):
         '''
@@ -304,134 +346,223 @@ class History():
             times: array of times
             values: array of value
         '''
-        # Store values as a masked array to make it possible to break the line during disconnections
-        return np.zeros((points,), dtype=np.object), np.ma.masked_array(np.zeros((points,), dtype=np.int))
+        # Points without a measurement hold the missing value to make it possible to break the line during disconnections
+        return np.empty((points,), dtype=np.float64), np.empty((points,), dtype=np.int32)
 
-    def arrays_full(self):
-        '''Handle a new point being added when the arrays are full
+    def timestamp(self, time):
+        '''Convert a datetime to the float seconds used to store times
 
-        New time and value arrays are created and the latter part of the old
-        ones are copied into them. If history_buffer points can be discarded from
-        the beginning of the old arrays while keeping points with at least
-        history_length in time then the new arrays will be the same size as the
-        old ones and those early points will be discarded. Otherwise all of the
-        points are kept and the arrays grow by history_buffer.
-
-        This keeps at least history_length worth of points without using too
-        much memory no matter how long the program runs for. filled_points is
-        updated to reflect the current valid points in the new arrays.
-
-        If logging is active then the log file will updated.
+        Args:
+            time: naive datetime object to convert
+        Returns:
+            seconds: float seconds since epoch
         '''
-        if self.logging is True:
-            self.write_log()
+        return (time-self.epoch).total_seconds()
 
-        old_points = len(self.times)
-        if self.times[-1]-self.times[self.history_buffer] >= self.history_length:
-            new_points = old_points
-            keep = old_points-self.history_buffer
-        else:
-            new_points = old_points+self.history_buffer
-            keep = old_points
+    def first_point(self):
+        '''Return the write index of the oldest point still in the buffers'''
+        return max(0, self.write_idx-self.capacity)
+
+    def grow(self):
+        '''Double the capacity of the buffers keeping all current points
 
-        times, values = self.allocate_arrays(new_points)
-        times[:keep] = self.times[-keep:]
-        values[:keep] = self.values[-keep:]
-        self.filled_points = keep
+        This is only needed when points arrive faster than expected_interval, so
+        that a full buffer still covers less than history_length. Points keep
+        their write indices and are placed at their new positions in the larger
+        buffers.
+        '''
+        indices = np.arange(self.first_point(), self.write_idx)
+        times, values = self.allocate_arrays(self.capacity*2)
+        new_mask = self.capacity*2-1
+        times[indices & new_mask] = self.times[indices & self.mask]
+        values[indices & new_mask] = self.values[indices & self.mask]
+
+        self.capacity *= 2
+        self.mask = new_mask
         self.times = times
         self.values = values
 
     def add_point(self, time, value):
         '''Add a data point to the history.
 
+        If the buffers are full the oldest point is overwritten unless it is
+        still within history_length of the new point, in which case the buffers
+        grow. If logging is active the log file is updated every history_buffer
+        points.
+
         Args:
             time: datetime object of the data point
-            value: parameter value
+            value: integer parameter value or missing if there is no measurement
         '''
-        if self.filled_points < len(self.times):
-            self.times[self.filled_points] = time
-            self.values[self.filled_points] = value
-            self.filled_points += 1
-        else: # if the arrays are full reallocate before adding the point
-            self.arrays_full()
-            self.add_point(time, value)
-    
+        seconds = self.timestamp(time)
+        write_idx = self.write_idx
+        i = write_idx & self.mask
+        # the slot being written holds the oldest point once the buffers are full
+        if write_idx >= self.capacity and seconds-self.times[i] < self.history_seconds:
+            self.grow()
+            i = write_idx & self.mask
+
+        self.times[i] = seconds
+        self.values[i] = value
+        write_idx += 1
+        self.write_idx = write_idx
+
+        if self.logging is True and write_idx-self.log_idx >= self.history_buffer:
+            self.write_log()
+
+    def ordered(self, array, start, stop):
+        '''Return the points of a buffer between two write indices in order
+
+        A view of the buffer is returned unless the range wraps around the end
+        of the buffer, in which case the two pieces are joined into a new array.
+
+        Args:
+            array: buffer to take points from (times or values)
+            start: write index of the first point
+            stop: write index after the last point
+        Returns:
+            points: array of the points in the order they were written
+        '''
+        first = start & self.mask
+        last = first+stop-start
+        if last <= self.capacity:
+            return array[first:last]
+        return np.concatenate((array[first:], array[:last-self.capacity]))
+
+    def search(self, time, side='left'):
+        '''Find the write index at which a time would be inserted
+
+        Args:
+            time: float seconds since epoch to search for
+            side: 'left' or 'right' as for numpy searchsorted
+        Returns:
+            index: write index of the insertion point
+        '''
+        start = self.first_point()
+        first = start & self.mask
+        last = first+self.write_idx-start
+        head = self.times[first:min(last, self.capacity)]
+        point = head.searchsorted(time, side)
+        if point < len(head) or last <= self.capacity:
+            return start+point
+        tail = self.times[:last-self.capacity]
+        return start+len(head)+tail.searchsorted(time, side)
+
     def active_range(self, time_range):
         '''Return the active portion of history going back at most time_range
 
         The start time of the active range is the last filled point minus the
-        time_range. The portion of the time and value arrays from this start
-        point to the last filled point are returned.
+        time_range. The points from this start time to the last filled point
+        are returned.
 
         Args:
             time_range: timedelta specifying time range to include
         Returns:
-            times: active time points
+            times: active time points as float seconds since epoch
             values: active values
         '''
-        if self.filled_points <= 1:
+        if self.write_idx <= 1:
             return None, None
 
-        start_time = self.times[self.filled_points-1]-time_range
-        start_point = self.times[:self.filled_points].searchsorted(start_time)
-        active_slice = slice(start_point, self.filled_points)
-        return self.times[active_slice], self.values[active_slice]
+        start_time = self.times[(self.write_idx-1) & self.mask]-time_range.total_seconds()
+        start_point = self.search(start_time)
+        return (self.ordered(self.times, start_point, self.write_idx),
+            self.ordered(self.values, start_point, self.write_idx))
     
     def save_history(self):
-        '''Save all filled points in the current arrays to a file'''
-        if self.filled_points <= 1:
+        '''Save all points currently in the history to a file'''
+        if self.write_idx <= 1:
             return
         if self.can_save is False:
             raise RuntimeError('Cannot save data')
         
-        start_time = self.times[0]
-        end_time = self.times[self.filled_points-1]
+        start_point = self.first_point()
+        start_time = self.times[start_point & self.mask]
+        end_time = self.times[(self.write_idx-1) & self.mask]
         file_spec = self.save_name(start_time, end_time)
         with open(file_spec, 'w+') as file_:
-            self.write_points(file_, slice(0, self.filled_points))
+            self.write_points(file_, start_point, self.write_idx)
     
     def save_name(self, start_time, end_time):
         '''Generate a file name for a range of times
         
         Args:
-            start_time: datetime of first point to save
-            end_time: datetime of last point to save
+            start_time: float seconds of first point to save
+            end_time: float seconds of last point to save
         Returns:
             file: file string to save to
         '''
         name = '{}__{}_spin_log.dat'.format(self.string_time(start_time), self.string_time(end_time))
         return os.path.join(self.log_dir, name)
 
-    def write_points(self, file_, write_slice):
-        '''Write a slice of history to an open file handle
+    def write_points(self, file_, start, stop):
+        '''Write a range of history to an open file handle
 
         Args:
             file_: An already opened file to write to
-            write_slice: Slice object specifying which points to write
+            start: write index of the first point to write
+            stop: write index after the last point to write
         '''
-        times = self.times[write_slice]
-        values = self.values[write_slice]
-        for t, v in zip(times, values):
-            line = '{} {:>6}\n'.format(self.string_time(t), str(v))
-            file_.write(line)
+        times = self.ordered(self.times, start, stop)
+        values = self.ordered(self.values, start, stop)
+        if len(times) == 0:
+            return
+
+        # format all of the points at once as fixed width records and write them from a single buffer
+        stamps = self.string_times(times).astype(np.bytes_)
+        numbers = np.where(values == self.missing, b'--', values.astype(np.bytes_))
+        width = max(6, np.char.str_len(numbers).max())
+        lines = np.empty((len(times),), dtype=[('time', stamps.dtype), ('space', 'S1'),
+            ('value', 'S{}'.format(width)), ('newline', 'S1')])
+        lines['time'] = stamps
+        lines['space'] = b' '
+        lines['value'] = np.char.rjust(numbers, width)
+        lines['newline'] = b'\n'
+        file_.write(lines.tostring())
     
     def string_time(self, time):
         '''Return a string formatted time suitable for saving and file names
         
         Args:
-            time: datetime object to convert
+            time: float seconds since epoch to convert
         Returns:
             str_time: string representing the time
         '''
-        return time.strftime('%Y-%m-%d-%H-%M-%S')
+        return datetime.utcfromtimestamp(time).strftime(self.time_format)
+
+    def string_times(self, times):
+        '''Return an array of string formatted times in the same format as string_time
+
+        All of the times are formatted at once by numpy rather than calling
+        strftime for each one.
+
+        Args:
+            times: array of float seconds since epoch to convert
+        Returns:
+            str_times: unicode array of strings representing the times
+        '''
+        stamps = np.datetime_as_string(times.astype(np.int64).astype('datetime64[s]')).astype('U19')
+        # replace the separators in YYYY-MM-DDTHH:MM:SS by viewing the strings as characters
+        stamps.view('U1').reshape(-1, 19)[:, [10, 13, 16]] = u'-'
+        return stamps
 
     def begin_logging(self):
-        '''Start periodically saving data to a log file as it is collected'''
+        '''Start periodically saving data to a log file as it is collected
+
+        The log file stays open while logging is active and is named for the
+        start time until logging ends, when it is renamed to include the time
+        of the last logged point.
+        '''
         if self.logging is True:
             raise RuntimeError('Cannot begin logging if logging is already active')
+        if self.can_save is False:
+            raise RuntimeError('Cannot save data')
 
-        self.log_start = datetime.now()
+        self.log_start = self.timestamp(datetime.now())
         self.log_end = self.log_start
+        self.log_idx = self.write_idx
+        self.log_path = self.save_name(self.log_start, self.log_end)
+        self.log_file = open(self.log_path, 'a+', 1 << 16)
         self.logging = True
 
     def write_log(self):
@@ -440,56 +571,57 @@ class History():
             raise RuntimeError('Cannot write log data if logging is not active')
         if self.can_save is False:
             raise RuntimeError('Cannot save data')
+        if self.write_idx == self.log_idx:
+            return
 
-        old_file = self.save_name(self.log_start, self.log_end)
-        new_end = self.times[self.filled_points-1]
-        new_file = self.save_name(self.log_start, new_end)
-
-        start_point = self.times[:self.filled_points].searchsorted(self.log_end, 'right')
-        log_slice = slice(start_point, self.filled_points)
-        with open(old_file, 'a+') as file_:
-            self.write_points(file_, log_slice)
-        os.rename(old_file, new_file)
+        # points are logged in order so the log index replaces searching for log_end
+        start_point = max(self.log_idx, self.first_point())
+        self.write_points(self.log_file, start_point, self.write_idx)
+        self.log_file.flush()
 
-        self.log_end = new_end
+        self.log_end = self.times[(self.write_idx-1) & self.mask]
+        self.log_idx = self.write_idx
 
     def end_logging(self):
-        '''Write unlogged data and stop periodically writing data'''
+        '''Write unlogged data, close the log file and stop periodically writing data'''
         if self.logging is False:
             raise RuntimeError('Cannot end logging if logging is not active')
 
         self.write_log()
+        self.log_file.close()
+        os.rename(self.log_path, self.save_name(self.log_start, self.log_end))
         self.logging = False
-        self.log_start = datetime.now()
+        self.log_start = self.timestamp(datetime.now())
         self.log_end = self.log_start
 
-class HistoryPlot(QtGui.QWidget, matplotlib.animation.TimedAnimation):
+class HistoryPlot(QtGui.QWidget):
     '''Real time plot of the history of a parameter.
 
     Plots the history of the value of a parameter as a function of time and
-    updates in real time.
+    updates in real time. The plotted points are kept in their own buffers that
+    are appended to as new points are added to the history, so that each frame
+    only has to convert the new points.
 
     Args:
         history: A History object to plot
-        config: a Configuration object to set the time limits and tick intervals
+        config: a Configuration object to set the time limits
     '''
     def __init__(self, history, config):
-        self.config = config
-        self.fig = matplotlib.figure.Figure()
-
         QtGui.QWidget.__init__(self)
-        FigureCanvasQTAgg(self.fig)
-        matplotlib.animation.TimedAnimation.__init__(self, self.fig, interval = 1000)
-
+        self.config = config
         self.history = history
         self.initialize_plot()
         self.setup_widgets()
 
+        self.timer = QtCore.QTimer(self)
+        self.timer.timeout.connect(self.draw_frame)
+        self.timer.start(1000)
+
     def setup_widgets(self):
         '''Set up the GUI elements for the plot/controls.'''
         vbox = QtGui.QVBoxLayout()
         self.setLayout(vbox)
-        vbox.addWidget(self.fig.canvas)
+        vbox.addWidget(self.plot_widget)
         slider = PlotRangeControl(self.config.limits, QtCore.Qt.Horizontal)
         vbox.addWidget(slider)
         vbox.addWidget(HistorySaveControls(self.history))
@@ -498,20 +630,41 @@ class HistoryPlot(QtGui.QWidget, matplotlib.animation.TimedAnimation):
 
     def initialize_plot(self):
         '''Setup the plot in an intial default state.'''
-        self.line1 = matplotlib.lines.Line2D([], [], color='blue')
-        self.axes = self.fig.add_subplot(111)
-        self.axes.add_line(self.line1)
-        self.axes.autoscale(True, 'x', True)
-        self.axes.xaxis.set_major_locator( matplotlib.dates.SecondLocator())
-        self.axes.xaxis.set_major_formatter(matplotlib.dates.DateFormatter('%H:%M:%S'))
-        self.max_range = timedelta(hours=24)
-        self.axes.grid(True)
+        # times are seconds of the naive local time so display them without a UTC offset
+        date_axis = pg.DateAxisItem(orientation='bottom', utcOffset=0)
+        self.plot_widget = pg.PlotWidget(axisItems={'bottom': date_axis})
+        self.plot_widget.setBackground('w')
+        self.plot_widget.showGrid(x=True, y=True)
+        self.plot_widget.setMouseEnabled(x=False, y=False)
+        self.plot_widget.hideButtons()
+        # NaN values break the line during disconnections
+        self.line1 = self.plot_widget.plot(pen='b', connect='finite')
+        # reduce the plotted points to the min/max of each pixel column of the plot
+        self.line1.setDownsampling(auto=True, method='peak')
+        self.line1.setClipToView(True)
+        self.y_limits = None
+
+        self.plot_times = np.empty((0,), dtype=np.float64)
+        self.plot_values = np.empty((0,), dtype=np.float64)
+        self.plot_start = 0
+        self.plot_stop = 0
+        self.plotted_idx = None # history write index after the last plotted point
+        self.plot_min = SlidingExtremum(np.minimum)
+        self.plot_max = SlidingExtremum(np.maximum)
+        self.set_max_range(timedelta(hours=24))
+
+        # ranges are set explicitly every frame, so start on the initial plot range instead of
+        # letting the empty plot autorange to an arbitrary span with tick spacing to match
+        self.plot_widget.disableAutoRange()
+        now = self.history.timestamp(datetime.now())
+        self.plot_widget.setXRange(now-self.max_seconds, now, padding=0)
 
     def set_max_range(self, value):
         '''Set the maximum time range displayed by the plot.
 
         If the selected plot range exceeds history_length then the maximum plot
-        range will be set to history_length.
+        range will be set to history_length. The range in seconds is cached for
+        use when drawing frames.
 
         Args:
             value: timedelta object holding the new maximum plot range
@@ -520,69 +673,166 @@ class HistoryPlot(QtGui.QWidget, matplotlib.animation.TimedAnimation):
             self.max_range = self.history.history_length
         else:
             self.max_range = value
+        self.max_seconds = self.max_range.total_seconds()
+        self.plotted_idx = None
 
-    def select_locator(self, time_range):
-        '''Setup a tick locator and formatter based on the range of the plot.
+    def append_plot_points(self, times, values):
+        '''Add points to the end of the plot buffers.
 
-        In order to keep the tick labels from overlapping the time interval of
-        the ticks must depend on the range of times in the plot.
+        When the buffers run out of space the plotted points are moved back to
+        the start of the buffers, which grow if they would be more than half
+        full. This keeps the cost of moving points constant per added point.
 
         Args:
-            time_range: timedelta object with the difference between the xlims
+            times: array of times to add
+            values: float array of values to add
         '''
-        for i, limit in enumerate(self.config.limits):
-            if time_range < limit:
-                loc = self.config.locators[i]
-                interval = self.config.intervals[i]
-                break
-        else:
-            loc = matplotlib.dates.HourLocator
-            interval = 6
-
-        if loc == matplotlib.dates.SecondLocator:
-            specifier = range(0, 60, interval)
-            format = '%H:%M:%S'
-        elif loc == matplotlib.dates.MinuteLocator:
-            specifier = range(0, 60, interval)
-            format = '%H:%M'
-        elif loc == matplotlib.dates.HourLocator:
-            specifier = range(0, 24, interval)
-            format = '%H:%M'
-
-        self.axes.xaxis.set_major_locator(loc(specifier))
-        self.axes.xaxis.set_major_formatter(matplotlib.dates.DateFormatter(format))
-
-    def new_frame_seq(self):
-        '''Provide an infinite counter to generate infinite frames.
-
-        TimedAnimation requires an iterator to generate frames. An infinite
-        counter causes it to draw frames until the program is closed.
+        points = len(times)
+        if self.plot_stop+points > len(self.plot_times):
+            count = self.plot_stop-self.plot_start
+            if 2*(count+points) > len(self.plot_times):
+                plot_times = np.empty((2*(count+points),), dtype=np.float64)
+                plot_values = np.empty((2*(count+points),), dtype=np.float64)
+            else:
+                plot_times = self.plot_times
+                plot_values = self.plot_values
+            plot_times[:count] = self.plot_times[self.plot_start:self.plot_stop]
+            plot_values[:count] = self.plot_values[self.plot_start:self.plot_stop]
+            self.plot_times = plot_times
+            self.plot_values = plot_values
+            self.plot_start = 0
+            self.plot_stop = count
+
+        self.plot_times[self.plot_stop:self.plot_stop+points] = times
+        self.plot_values[self.plot_stop:self.plot_stop+points] = values
+        self.plot_stop += points
+
+    def update_plot_points(self):
+        '''Bring the plot buffers up to date with the history.
+
+        Points added to the history since the last frame are appended and points
+        older than max_range are dropped from the start. The buffers are refilled
+        from the history after max_range changes or if the history has already
+        discarded points that were never plotted.
+
+        Returns:
+            Boolean indicating whether there are points to plot
         '''
-        return itertools.count(0, 1)
+        history = self.history
+        if history.write_idx <= 1:
+            return False
+
+        refill = self.plotted_idx is None or self.plotted_idx < history.first_point()
+        if refill:
+            times, values = history.active_range(self.max_range)
+            self.plot_start = 0
+            self.plot_stop = 0
+        else:
+            times = history.ordered(history.times, self.plotted_idx, history.write_idx)
+            values = history.ordered(history.values, self.plotted_idx, history.write_idx)
+        values = np.where(values == history.missing, np.nan, values)
+        self.append_plot_points(times, values)
+        self.plotted_idx = history.write_idx
+
+        first_idx = history.write_idx-len(values)
+        for extremum in (self.plot_min, self.plot_max):
+            if refill:
+                extremum.reset(first_idx, values)
+            else:
+                extremum.add(first_idx, values)
+
+        start_time = self.plot_times[self.plot_stop-1]-self.max_seconds
+        self.plot_start += self.plot_times[self.plot_start:self.plot_stop].searchsorted(start_time)
+        for extremum in (self.plot_min, self.plot_max):
+            extremum.drop_before(history.write_idx-(self.plot_stop-self.plot_start))
+        return True
 
-    def _draw_frame(self, framedata):
+    def draw_frame(self):
         '''Draw new up to date plot.'''
-        times, values = self.history.active_range(self.max_range)
-        if times is None and values is None:
+        if self.update_plot_points() is False:
             return
 
-        self.line1.set_data(times, values)
-        self._drawn_artists = [self.line1]
+        times = self.plot_times[self.plot_start:self.plot_stop]
+        values = self.plot_values[self.plot_start:self.plot_stop]
+        self.line1.setData(x=times, y=values)
 
-        # force autoscaling of the x axis
-        self.axes.autoscale(True, 'x', True)
-        self.axes.relim()
-        self.axes.autoscale_view()
+        # fit the x axis to the data
+        self.plot_widget.setXRange(times[0], times[-1], padding=0)
 
-        # set y limits
-        value_min = np.amin(values)
-        value_max = np.amax(values)
-        self.axes.set_ylim(value_min-100, value_max+100)
+        # only set y limits when they change to avoid relayout of the y axis every frame
+        if self.plot_min.value() is None:
+            return
+        y_limits = (self.plot_min.value()-100, self.plot_max.value()+100)
+        if y_limits != self.y_limits:
+            self.plot_widget.setYRange(*y_limits, padding=0)
+            self.y_limits = y_limits
+
+class SlidingExtremum():
+    '''Minimum or maximum of a window of points that slides forward
 
-        # format the x axis labels
-        left, right = self.axes.get_xlim()
-        time_range = timedelta(days=right-left)
-        self.select_locator(time_range)
+    Keeps a monotonic queue of (index, value) pairs holding only the points
+    that could still become the extremum as older points leave the window. The
+    extremum is always at the front of the queue, so adding points and finding
+    the extremum take constant amortized time. NaN values are ignored.
+
+    Args:
+        ufunc: np.minimum or np.maximum selecting which extremum to track
+    '''
+    def __init__(self, ufunc):
+        self.ufunc = ufunc
+        self.queue = deque()
+
+    def reset(self, start, values):
+        '''Replace the window with new points.
+
+        Args:
+            start: index of the first point
+            values: float array of point values
+        '''
+        indices = np.arange(start, start+len(values))
+        finite = ~np.isnan(values)
+        indices = indices[finite]
+        values = values[finite]
+
+        self.queue = deque()
+        if len(values) == 0:
+            return
+
+        # a point stays in the queue only if it beats every later point
+        later = self.ufunc.accumulate(values[::-1])[::-1]
+        keep = np.append(later[:-1] != later[1:], True)
+        self.queue.extend(zip(indices[keep].tolist(), values[keep].tolist()))
+
+    def add(self, start, values):
+        '''Add points to the end of the window.
+
+        Args:
+            start: index of the first point
+            values: float array of point values
+        '''
+        queue = self.queue
+        for index, value in enumerate(values.tolist(), start):
+            if value != value: # NaN
+                continue
+            while queue and self.ufunc(queue[-1][1], value) == value:
+                queue.pop()
+            queue.append((index, value))
+
+    def drop_before(self, index):
+        '''Remove points from the start of the window.
+
+        Args:
+            index: index of the first point to keep
+        '''
+        queue = self.queue
+        while queue and queue[0][0] < index:
+            queue.popleft()
+
+    def value(self):
+        '''Return the extremum of the window or None if it has no values.'''
+        if self.queue:
+            return self.queue[0][1]
+        return None
 
 class PlotRangeControl(QtGui.QWidget):
     '''Slider for setting/displaying the maximum plot range
@@ -681,22 +931,31 @@ class PressureControl(QtGui.QSpinBox):
     to match the behaviour of a MAS controller. Steps go by 10 and upon
     editingFinished the value gets rounded to 10. A set_pressure signal is
     emitted after stepping with the arrows, pressing enter, or clicking away.
+    The signal is delayed by emit_delay so that a burst of steps (e.g. holding
+    an arrow key) only emits once with the final value.
 
     Args:
         parent: parent widget
     """
+    emit_delay = 50 # milliseconds to wait for further changes before emitting set_pressure
+
     def __init__(self, parent):
         QtGui.QSpinBox.__init__(self, parent)
         self.setRange(0, 5000)
         self.setSingleStep(10)
         self.editingFinished.connect(self.new_value)
 
+        self.emit_timer = QtCore.QTimer(self)
+        self.emit_timer.setSingleShot(True)
+        self.emit_timer.setInterval(self.emit_delay)
+        self.emit_timer.timeout.connect(self.emit_pressure)
+
     def stepBy(self, step):
         """Overload stepping to handle non-multiples of 10.
 
         Ensures that if the current value is not a multiple of 10 the value
         steps up or down to the next multiple of 10 instead of stepping by
-        10. Emits set_pressure signal after stepping.
+        10. Schedules set_pressure signal after stepping.
 
         Args:
             step: number of steps to take
@@ -708,106 +967,255 @@ class PressureControl(QtGui.QSpinBox):
             if val%10 != 0:
                 self.setValue((self.value()//10+1)*10)
         QtGui.QSpinBox.stepBy(self, step)
-        self.emit(QtCore.SIGNAL('set_pressure(int)'), self.value())
+        self.emit_timer.start()
 
     def new_value(self):
         """Round value to nearest multiple of 10.
 
         Rounds the box value to the nearest multiple of ten to match the
-        behaviour of the MAS controller. Emits set_pressure signal after rounding.
+        behaviour of the MAS controller. Schedules set_pressure signal after
+        rounding.
         """
         if self.value()%10 != 0:
             self.setValue(int(round(self.value(), -1)))
+        self.emit_timer.start()
+
+    def emit_pressure(self):
+        """Emit set_pressure signal with the current value."""
         self.emit(QtCore.SIGNAL('set_pressure(int)'), self.value())
 
-class MASTCPThread(QtCore.QThread):
-    """Operates a thread for asynchronous communication with a MAS controller.
+class MASTCPWorker(QtCore.QObject):
+    """Handles asynchronous communication with a MAS controller.
 
-    Add commands to the queue in the form of (command,(args...)) to send them.
-    Periodically polls MAS controller for its status and emits got_status signal
-    with the returned values. Emits reconnect signal in response to communication
-    socket errors or timeouts. Set retry_dialog_open to False after reconnect
-    signal to break loop and try to reconnect. Set running to False to break
-    execution loop and finish thread.
+    The worker is meant to be moved to its own QThread with start connected to
+    the thread's started signal. Commands in the form of (command,(args...))
+    are delivered to the queue_command slot by a queued signal and sent as soon
+    as the thread's event loop gets to them. A QTimer in the thread's event loop
+    periodically polls MAS controller for its status, emitting got_status signal
+    with the returned values. Emits reconnect signal in response to
+    communication socket errors or timeouts and stops polling until
+    connect_controller is called. Commands queued while disconnected are sent
+    once the connection is made again. Call stop to close the connection and
+    finish the thread's event loop.
 
     Args:
         parent: parent widget
-        queue: command queue
+        offline: whether to generate fake data instead of connecting
     """
-    def __init__(self, parent, queue, offline):
-        QtCore.QThread.__init__(self, parent)
+    collapsible = ('DP', 'BP') # commands where only the latest of consecutive repeats matters
+    max_batch = 16 # most commands to send at once
+    batch_pause = 0.05 # seconds to wait after sending a batch of commands
+    # send VD before the AS response arrives, not yet verified on a MAS controller
+    pipeline_poll = False
+    poll_interval = 1000 # milliseconds between status polls
+    offline_interval = 50 # milliseconds between fake status points when offline
+    retry_wait = 0.05 # seconds before the second connection test
+    retry_max_wait = 1 # most seconds between connection tests
+    retry_jitter = 0.2 # fraction that the time between connection tests is varied by
+    timeout_message = 'Timeout error: Check that the MAS controller is in remote mode.'
+    connection_message = ('Connection error: Check that no other programs are connected to the MAS controller.\n'
+        'You may need to enter "set mas off" in RNMRA')
+
+    def __init__(self, parent, offline):
+        # no Qt parent so the worker can be moved to another thread
+        QtCore.QObject.__init__(self)
         self.parent = parent
-        self.queue = queue
+        self.queue = deque()
         self.offline = offline
-        self.running = True
-        self.retry_dialog_open = False
+        self.handler = None
+        self.timer = None
+        self.command_timer = None
+        self.offline_step = 0
 
-    def run(self):
-        """Run loop to connect to MAS controller.
+    @QtCore.pyqtSlot()
+    def start(self):
+        """Set up the timers in the worker thread and connect.
 
-        Runs a loop so long as running is True that connects to MAS controller
-        and handles commands and polling. Emits reconnect signal in response to
-        socket errors or timeouts and waits for retry_dialog_open to be false to
-        continue loop.
+        In offline mode the poll timer generates fake data instead.
         """
-        while self.running:
-            if self.offline:
-                self.run_offline()
-                continue
+        # a zero interval single shot timer sends commands once the events
+        # already waiting have been handled, so a burst of commands is batched
+        self.command_timer = QtCore.QTimer(self)
+        self.command_timer.setSingleShot(True)
+        self.command_timer.timeout.connect(self.send_commands)
+        self.timer = QtCore.QTimer(self)
+        if self.offline:
+            self.timer.timeout.connect(self.poll_offline)
+            self.timer.start(self.offline_interval)
+        else:
+            self.timer.timeout.connect(self.poll)
+            self.connect_controller()
+
+    @QtCore.pyqtSlot()
+    def connect_controller(self):
+        """Connect to the MAS controller and start polling.
+
+        Commands queued while disconnected are sent before the first poll.
+        Emits reconnect signal if the connection cannot be made.
+        """
+        try:
+            self.handler = MASTCPHandler()
+        except socket.timeout: # socket.timeout has to be before socket.error because it is a subtype of it
+            self.connection_lost(self.timeout_message)
+            return
+        except socket.error:
+            self.connection_lost(self.connection_message)
+            return
+
+        self.timer.start(self.poll_interval)
+        self.send_commands()
+        self.poll()
 
-            try:
-                self.run_connection()
-            except socket.timeout: # socket.timeout has to be before socket.error because it is a subtype of it
-                self.retry_dialog_open = True
-                self.emit(QtCore.SIGNAL('reconnect(QString)'),
-                    'Timeout error: Check that the MAS controller is in remote mode.')
-            except socket.error:
-                self.retry_dialog_open = True
-                self.emit(QtCore.SIGNAL('reconnect(QString)'),
-                    'Connection error: Check that no other programs are connected to the MAS controller.\nYou may need to enter "set mas off" in RNMRA')
-            while self.retry_dialog_open:
-                self.msleep(100)
-
-    def run_connection(self):
-        """Connect to the MAS controller and loop to poll status/send commands.
-
-        Opens a TCP socket to the MAS controller and loops as long as running is
-        True. On each loop either send the next command in the queue or poll the
-        status if the queue is empty. The loop is broken if running is set to
-        False or by socket errors. Signal got_status is emitted every time the
-        status is polled. In the event of a timeout an attempt is made to retry
-        communication before breaking the loop.
+    @QtCore.pyqtSlot(object)
+    def queue_command(self, command):
+        """Add a command to the queue and schedule sending it.
+
+        Args:
+            command: tuple of (command,(args...))
+        """
+        self.queue.append(command)
+        if not self.command_timer.isActive():
+            self.command_timer.start(0)
+
+    @QtCore.pyqtSlot()
+    def send_commands(self):
+        """Send the commands waiting in the queue.
+
+        Up to max_batch commands are sent back to back and sending the rest is
+        scheduled after any status poll that is due. Commands are held in the
+        queue while there is no connection. In offline mode the commands are
+        printed to the terminal for debugging purposes instead.
         """
-        with MASTCPHandler() as handler:
-            while self.running:
-                try:
-                    if self.queue.empty():
-                        status, status_time = self.poll_status(handler)
-                        self.emit(QtCore.SIGNAL('got_status(PyQt_PyObject)'), (status, status_time))
-                        self.sleep(1)
-                    else:
-                        command = self.queue.get()
-                        handler.send_command(*command)
-                        self.msleep(50)
-                except socket.timeout as error:
-                    if self.retry_connection(handler) is False:
-                        raise error
+        if self.offline:
+            for _ in range(self.max_batch):
+                if not self.queue:
+                    break
+                print(self.next_command())
+        else:
+            self.communicate(self.send_batch)
+
+        if self.queue and (self.offline or self.handler is not None):
+            self.command_timer.start(0)
+
+    def send_batch(self):
+        """Send up to max_batch commands from the queue to the MAS controller.
+
+        Each command is only taken from the queue as it is sent, so if sending
+        one fails the commands after it stay queued. A single pause after the
+        batch gives the MAS controller time to act on the commands before
+        anything else is sent to it.
+        """
+        send_command = self.handler.send_command
+        queue = self.queue
+        sent = False
+        for _ in range(self.max_batch):
+            if not queue:
+                break
+            send_command(*self.next_command())
+            sent = True
+        if sent:
+            time.sleep(self.batch_pause)
+
+    @QtCore.pyqtSlot()
+    def poll(self):
+        """Poll the status of the MAS controller.
+
+        The status is emitted with got_status signal.
+        """
+        self.communicate(self.send_poll)
+
+    def send_poll(self):
+        """Request the status of the MAS controller and emit got_status."""
+        status, status_time = self.poll_status(self.handler)
+        self.emit(QtCore.SIGNAL('got_status(PyQt_PyObject)'), (status, status_time))
+
+    def communicate(self, action):
+        """Communicate with the MAS controller and handle connection issues.
+
+        In the event of a timeout an attempt is made to retry communication
+        before giving up on the connection. Nothing is done while there is no
+        connection.
+
+        Args:
+            action: function doing the communication with self.handler
+        """
+        if self.handler is None:
+            return
+
+        try:
+            action()
+        except socket.timeout: # socket.timeout has to be before socket.error because it is a subtype of it
+            if self.retry_connection(self.handler) is False:
+                self.connection_lost(self.timeout_message)
+        except socket.error:
+            self.connection_lost(self.connection_message)
+
+    def connection_lost(self, message):
+        """Stop polling, close the connection and emit reconnect signal.
+
+        Args:
+            message: text describing the connection issue
+        """
+        self.timer.stop()
+        self.close_handler()
+        self.emit(QtCore.SIGNAL('reconnect(QString)'), message)
+
+    def close_handler(self):
+        """Close the connection to the MAS controller if it is open."""
+        if self.handler is not None:
+            self.handler.close()
+            self.handler = None
+
+    @QtCore.pyqtSlot()
+    def stop(self):
+        """Stop polling, close the connection and finish the thread's event loop."""
+        if self.timer is not None:
+            self.timer.stop()
+            self.command_timer.stop()
+        self.close_handler()
+        self.thread().quit()
+
+    def next_command(self):
+        """Remove and return the next command waiting in the queue.
+
+        Consecutive commands in collapsible are reduced to the last one, since
+        only the final set point matters when a value is changed rapidly.
+
+        Returns:
+            The next command to send
+        """
+        # the queue is only used in the worker thread so it cannot change
+        # while the repeats are taken
+        queue = self.queue
+        command = queue.popleft()
+        if command[0] in self.collapsible:
+            popleft = queue.popleft
+            while queue and queue[0][0] == command[0]:
+                command = popleft()
+        return command
 
     def poll_status(self, handler):
         """Poll the status of the MAS controller.
 
         Request and return the status of the controller and a corresponding
-        timestamp.
+        timestamp. If pipeline_poll is set both requests are sent before waiting
+        for the responses so the second is on its way while the controller
+        answers the first, otherwise each request waits for the previous
+        response.
 
         Args:
             handler: MASTCPHandler for the MAS controller
         Returns:
             Tuple containing a MASStatus and its timestamp
         """
-        response = handler.send_command('AS', tuple())
-        self.msleep(50)
+        handler.send_message('AS')
+        if self.pipeline_poll:
+            handler.send_message('VD')
+        response = handler.receive_response()
         status_time = datetime.now()
-        spin_set = handler.send_command('VD', tuple())
+        if not self.pipeline_poll:
+            handler.send_message('VD')
+        spin_set = handler.receive_response()
         response.append(spin_set[0])
         status = MASStatus(*response[1:])
         return (status, status_time)
@@ -817,44 +1225,49 @@ class MASTCPThread(QtCore.QThread):
 
         Test the connection several times over a few seconds to see if a timeout
         issue was temporary or a fluke. Return True if a connection test is
-        successsful or False if the time limit is reached.
+        successsful or False if the time limit is reached or the MAS controller
+        closes the connection. The wait between tests starts short to catch a
+        quick recovery and doubles up to a limit for longer outages. Late
+        responses to earlier commands are discarded as they arrive between tests
+        and after a successful test, so that they are not mistaken for responses
+        to later commands.
 
         Args:
             handler: handler: MASTCPHandler for the MAS controller
         Returns:
             Boolean indicating success or failure of the retry attempts
         """
-        start_time = time.time()
-        while time.time()-start_time < 4*handler.timeout_limit:
-            if handler.test_connection():
-                self.sleep(handler.timeout_limit)
-                handler.socket.recv(128)
-                return True
-            self.msleep(100)
+        deadline = monotonic()+4*handler.timeout_limit
+        wait = self.retry_wait
+        try:
+            while monotonic() < deadline:
+                if handler.test_connection():
+                    handler.discard_input(handler.timeout_limit)
+                    return True
+                # jitter keeps the tests from falling into step with the controller
+                handler.discard_input(wait*random.uniform(1-self.retry_jitter, 1+self.retry_jitter))
+                wait = min(2*wait, self.retry_max_wait)
+        except socket.error:
+            return False
         return False
 
-    def run_offline(self):
+    @QtCore.pyqtSlot()
+    def poll_offline(self):
         """Generate fake spinning data for running without a MAS controller.
 
         This function generates a very simple (and unrealistic) pattern of
-        spinning data that repeatedly ramps from 0 to 100. This fake data
-        enables development and testing of this program without needing to
-        actually connect to a MAS controller. Commands in the queue are printed
-        to the terminal for debugging purposes.
+        spinning data that repeatedly ramps from 0 to 100, one step each time it
+        is called. This fake data enables development and testing of this
+        program without needing to actually connect to a MAS controller.
         """
-        for n in range(100):
-            if self.running is False:
-                return
-
-            if self.queue.empty():
-                status = MASStatus(str(n),'0','0','0','0')
-                status_time = datetime.now()
-                self.emit(QtCore.SIGNAL('got_status(PyQt_PyObject)'), (status, status_time))
-            else:
-                command = self.queue.get()
-                print(command)
-            self.msleep(50)
-        self.parent.spinning_history.add_point(datetime.now(), np.ma.masked)
+        status = MASStatus(str(self.offline_step),'0','0','0','0')
+        status_time = datetime.now()
+        self.emit(QtCore.SIGNAL('got_status(PyQt_PyObject)'), (status, status_time))
+
+        self.offline_step += 1
+        if self.offline_step == 100:
+            self.offline_step = 0
+            self.parent.spinning_history.add_point(datetime.now(), History.missing)
 
 class MASTCPHandler:
     """Manages TCP communication with an MAS controller.
@@ -864,31 +1277,58 @@ class MASTCPHandler:
     send_command to send a command to the MAS controller and receive the reponse
     as a return value.
 
+    The configuration and symbols files do not change while the program runs,
+    so they are only read by the first handler and shared with later ones.
+
     Args:
         address: optional tuple of (node, port) to connect to the MAS controller
             if not specified then the values will be loaded from symbols.sh
     """
     timeout_limit = 3
+    # translation tables to flip the high bit of every byte of a message
+    encode_table = bytes(bytearray((n+128) & 0xFF for n in range(256)))
+    decode_table = bytes(bytearray((n-128) & 0xFF for n in range(256)))
+    cached_command_table = None # command table loaded by the first handler
+    cached_address = None # address loaded by the first handler without an explicit address
 
     def __init__(self, address=None):
+        handler_class = self.__class__
         if address == None:
-            address = self.get_address()
+            if handler_class.cached_address is None:
+                handler_class.cached_address = self.get_address()
+            address = handler_class.cached_address
 
-        self.command_table = self.load_cfg()
+        if handler_class.cached_command_table is None:
+            handler_class.cached_command_table = self.load_cfg()
+        self.command_table = handler_class.cached_command_table
 
+        self.received = bytearray() # data received past the end of the last response
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.settimeout(self.timeout_limit)
         self.socket.connect(address)
+        # commands are small and wait for a response, so send them without delay
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
     def __exit__(self, type, value, traceback):
         """Close socket on exit."""
-        time.sleep(0.1)
-        self.socket.close()
+        self.close()
 
     def __enter__(self):
         """Return self when used in with block."""
         return self
 
+    def close(self):
+        """Close the socket to the MAS controller.
+
+        The socket is shut down first so any data still waiting to be sent is
+        flushed by the kernel instead of waiting here for it to go out.
+        """
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error: # the connection may already be gone
+            pass
+        self.socket.close()
+
     def find_cfg(self):
         """Find MAS command configuration file.
 
@@ -911,32 +1351,48 @@ class MASTCPHandler:
         """Load MAS command configuration file.
 
         Returns:
-            dict of MAS commands
+            dict of MAS commands with tuples of (number of arguments, number of
+            response values, encoded message prefix)
         """
         cfg_file = self.find_cfg()
         with open(cfg_file) as file_:
-            lines = file_.readlines()
+            lines = file_.read().splitlines()
 
         if lines[0].split()[0] != 'MASCMD':
             raise IOError('Invalid configuration file')
 
-        commands = {}
-        for line in lines[1:]:
-            line = line.strip()
-            if line == '':
-                break
-
-            if line == ';':
-                continue
+        # the entries end at the first blank line and may be separated by ;
+        entries = [line.split()[:2] for line in takewhile(bool, (line.strip() for line in lines[1:]))
+            if line != ';']
 
-            entry = line.split()
-            vals = entry[1].split(',')
-            if entry[0] != vals[0]:
+        commands = {}
+        encode_prefix = self.encode_prefix
+        for name, spec in entries:
+            vals = spec.split(',')
+            if name != vals[0]:
                 raise IOError('Invalid configuration entry')
 
-            commands[vals[0]] = [int(vals[1]), int(vals[2])]
+            nargs = int(vals[1])
+            commands[name] = (nargs, int(vals[2]), encode_prefix(name if nargs == 0 else name+' ', nargs))
         return commands
 
+    def encode_prefix(self, prefix, nargs):
+        """Encode the part of a command message that is the same for every call.
+
+        Commands without arguments are encoded in full with their terminator so
+        they can be sent as is.
+
+        Args:
+            prefix: command followed by a space if it takes arguments
+            nargs: number of arguments the command takes
+
+        Returns:
+            Encoded byte string
+        """
+        if nargs == 0:
+            return self.encode_message(prefix)
+        return prefix.translate(self.encode_table)
+
     def find_symbols(self):
         """Find spectrometer symbols shell script file.
 
@@ -966,19 +1422,16 @@ class MASTCPHandler:
         with open(symbols_file) as file_:
             lines = file_.readlines()
 
-        node_line = ['export', 'TRM1_TCP_NODE', '=']
-        port_line = ['export', 'TRM1_TCP_PORT', '=']
+        values = {}
         for line in lines:
-            parsed = list(shlex.shlex(line))
-            if parsed[:3] == node_line and len(parsed) == 4:
-                node = parsed[3][1:-1]
-            elif parsed[:3] == port_line and len(parsed) == 4:
-                port = int(parsed[3][1:-1])
+            match = SYMBOL_PATTERN.match(line)
+            if match is not None:
+                values[match.group(1)] = next(v for v in match.group(2, 3, 4) if v is not None)
 
-        if 'port' not in locals() or 'node' not in locals():
+        if 'TRM1_TCP_NODE' not in values or 'TRM1_TCP_PORT' not in values:
             raise IOError('MAS controller address and port not in symbols.sh')
 
-        return (node, port)
+        return (values['TRM1_TCP_NODE'], int(values['TRM1_TCP_PORT']))
 
     def send_command(self, command, args=tuple()):
         """Send a command to the MAS controller and receive a response.
@@ -994,32 +1447,77 @@ class MASTCPHandler:
         Returns:
             Response as list of strings
         """
-        if command not in self.command_table:
+        self.send_message(command, args)
+        return self.receive_response()
+
+    def send_message(self, command, args=tuple()):
+        """Send a command to the MAS controller without waiting for a response.
+
+        Call receive_response once for each message sent to get the responses in
+        order. The command and the number of args must match the command table.
+
+        Args:
+            command: two letter string indicating the command
+            args (optional): collection of arguments to send with the command
+        """
+        entry = self.command_table.get(command)
+        if entry is None:
             raise ValueError('Unknown command')
-        else:
-            nargs, _ = self.command_table[command]
+        nargs, _, prefix = entry
 
         if len(args) != nargs:
             raise ValueError('Incorrect number of arguments for command')
-        nargs = len(args)
-        if nargs >= 1:
-            command+=' '+' '.join(args)
-
-        encoded = self.encode_message(command)
-        self.socket.send(encoded)
-
-        start_time = time.time()
-        received = ''
-        while time.time()-start_time < self.timeout_limit:
-            received += self.socket.recv(80)
-            if received[-2:] == '\x8d\x8a': # \r\n terminator
-                break
+        if nargs == 0:
+            encoded = prefix
         else:
-            raise socket.timeout('MAS controller took too long to respond')
+            encoded = prefix+self.encode_message(' '.join(args))
+        self.socket.sendall(encoded)
+
+    def receive_response(self):
+        """Receive the next response from the MAS controller.
+
+        Responses to several messages may arrive together, so the response is
+        read from the receive buffer. If the response takes to long
+        socket.timeout is raised.
+
+        Returns:
+            Response as list of strings
+        """
+        return self.decode_message(self.read_until(b'\x8d\x8a')) # \r\n terminator
+
+    def read_until(self, terminator):
+        """Read from the socket up to and including a terminator.
 
-        response = self.decode_message(received)
+        Data is received in large chunks into a buffer that is kept between
+        calls, so a chunk holding more than one response is only received once
+        and the rest of it is returned by later calls.
 
-        return response
+        Args:
+            terminator: byte string marking the end of the data to read
+
+        Returns:
+            Byte string ending with the terminator
+        """
+        deadline = monotonic()+self.timeout_limit
+        received = self.received
+        recv = self.socket.recv
+        overlap = len(terminator)-1
+        end = received.find(terminator)
+        while end < 0:
+            if monotonic() >= deadline:
+                raise socket.timeout('MAS controller took too long to respond')
+            chunk = recv(4096)
+            if not chunk:
+                raise socket.error('MAS controller closed the connection')
+            # the terminator may be split between the last chunk and this one
+            search_start = max(len(received)-overlap, 0)
+            received.extend(chunk)
+            end = received.find(terminator, search_start)
+
+        end += overlap+1
+        data = bytes(received[:end])
+        del received[:end]
+        return data
 
     def encode_message(self, message):
         """Create byte string to send to MAS controller.
@@ -1033,9 +1531,7 @@ class MASTCPHandler:
         Returns:
             Encoded byte string
         """
-        encoded_bytes = [chr(ord(n)+128) for n in message]
-        encoded_bytes.append('\x8d') # \r terminator
-        return ''.join(encoded_bytes)
+        return message.translate(self.encode_table)+b'\x8d' # \r terminator
 
     def decode_message(self, message):
         """Decode response from MAS controller.
@@ -1050,8 +1546,7 @@ class MASTCPHandler:
         Returns:
             Response as list of strings
         """
-        decoded_bytes = [chr(ord(n)-128) for n in message]
-        return ''.join(decoded_bytes)[:-2].split()
+        return message.translate(self.decode_table)[:-2].split()
 
     def test_connection(self):
         """Test the connection to the MAS controller.
@@ -1069,9 +1564,37 @@ class MASTCPHandler:
         
         return message == ['OK']
 
+    def discard_input(self, wait):
+        """Read and discard data arriving from the MAS controller for a while.
+
+        Uses select to wake up as soon as data arrives rather than sleeping for
+        the whole time and reading afterwards.
+
+        Args:
+            wait: seconds to keep discarding data for
+        """
+        del self.received[:]
+        deadline = monotonic()+wait
+        remaining = wait
+        sockets = [self.socket]
+        recv = self.socket.recv
+        while remaining > 0:
+            readable, _, _ = select.select(sockets, [], [], remaining)
+            if readable and not recv(4096):
+                raise socket.error('MAS controller closed the connection')
+            remaining = deadline-monotonic()
+
 class Configuration():
     '''Configures the available ranges and tick intervals for history plotting'''
+    cached_entries = None # (limits, locators, intervals) loaded by the first instance
+
     def __init__(self):
+        if Configuration.cached_entries is None:
+            Configuration.cached_entries = self.load_entries()
+        self.limits, self.locators, self.intervals = (list(values) for values in Configuration.cached_entries)
+
+    def load_entries(self):
+        '''Read config_times.dat, which does not change while the program runs'''
         config_dir = os.path.dirname(os.path.realpath(__file__))
         config_file = os.path.join(config_dir, 'config_times.dat')
         with open(config_file) as file_:
@@ -1086,6 +1609,7 @@ class Configuration():
 
         for entry in raw[1:]:
             self.add_entry(entry)
+        return (tuple(self.limits), tuple(self.locators), tuple(self.intervals))
 
     def add_entry(self, entry):
         tokens = entry.split()
@@ -1105,13 +1629,10 @@ class Configuration():
         interval = int(tokens[2])
         if tokens[3] == 's':
             interval_delta = timedelta(seconds=interval)
-            locator = matplotlib.dates.SecondLocator
         elif tokens[3] == 'm':
             interval_delta = timedelta(minutes=interval)
-            locator = matplotlib.dates.MinuteLocator
         elif tokens [3] == 'h':
             interval_delta = timedelta(hours=interval)
-            locator = matplotlib.dates.HourLocator
         else:
             raise IOError('Invalid time unit in configuration: {}'.format(tokens[3]))
         
@@ -1121,11 +1642,12 @@ class Configuration():
             raise IOError('Time limits must be in increasing order')
         
         self.limits.append(limit)
-        self.locators.append(locator)
+        self.locators.append(tokens[3]) # tick interval unit: 's', 'm' or 'h'
         self.intervals.append(interval)
 
 def view_gui(args):
     config = Configuration()
+    pg.setConfigOptions(useOpenGL=True, antialias=False)
 
     app = QtGui.QApplication(sys.argv)
     wind = MASView(app, config, args.log_dir, args.offline)